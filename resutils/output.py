@@ -5,6 +5,8 @@ Created on Mon Jun 17 15:25:25 2019
 
 @author: ggaregnani
 """
+import logging
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
 from pint import UnitRegistry
@@ -16,6 +18,7 @@ from matplotlib import colors
 CLRS_SUN = "#F19B03 #F6B13D #F9C774 #FDDBA3 #FFF0CE".split()
 CMAP_SUN = colors.LinearSegmentedColormap.from_list("solar", CLRS_SUN)
 ureg = UnitRegistry()
+logger = logging.getLogger(__name__)
 
 
 def search(
@@ -45,21 +48,59 @@ def search(
     return None
 
 
-def production_per_plant(json: Dict[str, Any], kind: str = "PV") -> float:
+@lru_cache(maxsize=None)
+def _parse_unit(unit: str) -> Any:
+    """
+    Return the pint unit of a string, parsing each string only once
+    """
+    return ureg.Unit(unit)
+
+
+def index_indicators(
+    indicator_list: List[Dict[str, str]]
+) -> Dict[str, Tuple[float, str]]:
+    """
+    Return a dictionary with the value and the unit of each indicator name,
+    to be built once and reused for several lookups
+
+    >>> index_indicators([{'unit': 'MWh/yr', 'name': 'Total energy production',
+    ...                    'value': '2887254.54'}])
+    {'Total energy production': (2887254.54, 'MWh/yr')}
+    """
+    return {dic["name"]: (float(dic["value"]), dic["unit"]) for dic in indicator_list}
+
+
+def production_per_plant(
+    json: Dict[str, Any],
+    kind: str = "PV",
+    indicators: Optional[Dict[str, Tuple[float, str]]] = None,
+) -> float:
     """
     Return the value of the production of a single plant
 
     :param json: json to parse with results
+    :param indicators: index of the json indicators, as returned by
+        index_indicators, built from the json when missing; pass it to
+        reuse it when looping over several kinds
 
     :returns: the vale
+    :raises KeyError: if an indicator is missing
+
+    >>> from types import SimpleNamespace
+    >>> financial = SimpleNamespace(investement_cost=1000.,
+    ...                             lcoe=lambda energy, i_r: 0.1)
+    >>> plant = SimpleNamespace(energy_production=np.float64(1500.),
+    ...                         n_plants=np.float64(10.), financial=financial)
+    >>> ind = get_indicators("PV", plant, None, np.array([10.]), 5)
+    >>> production_per_plant({"result": {"indicator": ind}}, kind="PV")
+    <Quantity(1.5, 'megawatt_hour / year')>
     """
-    value, unit = search(
-        json["result"]["indicator"], "{} total energy production".format(kind)
-    )
-    energy = ureg.Quantity(value, unit)
-    n_plants, unit = search(
-        json["result"]["indicator"], "Number of installed {} Systems".format(kind)
-    )
+    if indicators is None:
+        indicators = index_indicators(json["result"]["indicator"])
+    value, unit = indicators[f"{kind} total energy production"]
+    # use the same name written by get_indicators
+    n_plants, _ = indicators[f"Number of installed {kind.lower()} systems"]
+    energy = value * _parse_unit(unit)
     e_plant = energy / n_plants
     return e_plant
 
@@ -81,25 +122,26 @@ def get_indicators(
     )
     tot_setup_costs = plant.financial.investement_cost * n_plants
     lcoe_plant = plant.financial.lcoe(plant.energy_production, i_r=discount_rate / 100)
+    kind_lower = kind.lower()
     return [
         {
             "unit": unit,
-            "name": "{} total energy production".format(kind),
+            "name": f"{kind} total energy production",
             "value": str(round(tot_en_gen, 2)),
         },
         {
             "unit": "Million of EUR",
-            "name": "{} total setup costs".format(kind),  # MEUR
+            "name": f"{kind} total setup costs",  # MEUR
             "value": str(round(tot_setup_costs / 1000000)),
         },
         {
             "unit": "-",
-            "name": "Number of installed {} systems".format(kind.lower()),
+            "name": f"Number of installed {kind_lower} systems",
             "value": str(round(n_plants)),
         },
         {
             "unit": "EUR/kWh",
-            "name": "Levelized cost of {} energy".format(kind.lower()),
+            "name": f"Levelized cost of {kind_lower} energy",
             "value": str(round(lcoe_plant, 2)),
         },
     ]
@@ -110,14 +152,35 @@ def get_raster(
 ) -> List[Dict[str, str]]:
     """
     Return a dictionary with the output raster and the simbology
+
+    most_suitable can be an array or the path of a raster file, in the
+    latter case the raster is read by blocks and never loaded in memory.
     """
-    most_suitable, unit, factor = resu.best_unit(
-        most_suitable,
-        current_unit="kWh/pixel/yr",
-        no_data=0,
-        fstat=np.min,
-        powershift=0,
-    )
+    sample = None
+    if isinstance(most_suitable, str):
+        # choose the unit on the minimum, then scale each block, the
+        # sample is reused by quantile_colors to read the raster only once
+        in_ds = gdal.Open(most_suitable)
+        sample = sample_valid(in_ds.GetRasterBand(1), no_data_value=0)
+        _, min_value, _, _ = sample
+        del in_ds
+        _, unit, scale = resu.best_unit(
+            np.array([min_value]),
+            current_unit="kWh/pixel/yr",
+            no_data=0,
+            fstat=np.min,
+            powershift=0,
+        )
+    else:
+        most_suitable, unit, _ = resu.best_unit(
+            most_suitable,
+            current_unit="kWh/pixel/yr",
+            no_data=0,
+            fstat=np.min,
+            powershift=0,
+        )
+        # the array has already been scaled
+        scale = 1.0
     out_ds, symbology = quantile_colors(
         most_suitable,
         output_suitable,
@@ -128,12 +191,14 @@ def get_raster(
         gtype=gdal.GDT_Byte,
         unit=unit,
         options="compress=DEFLATE TILED=YES " "TFW=YES " "ZLEVEL=9 PREDICTOR=1",
+        factor=scale,
+        sample=sample,
     )
     del out_ds
 
     return [
         {
-            "name": "layers of most suitable roofs for {}".format(kind),
+            "name": f"layers of most suitable roofs for {kind}",
             "path": output_suitable,
             "type": "custom",
             "symbology": symbology,
@@ -153,8 +218,14 @@ def hourly_indicators(df, capacity):
 
     # there is no difference by using integration methods such as
     # trap integration
-    tot_energy = df.sum()
-    working_hours = df[df > 0].count()
+    if df.ndim == 1:
+        # single profile: avoid the filtered copy of df[df > 0]
+        values = df.to_numpy(copy=False)
+        tot_energy = np.nansum(values)
+        working_hours = np.count_nonzero(values > 0)
+    else:
+        tot_energy = df.sum()
+        working_hours = df[df > 0].count()
     equivalent_hours = tot_energy / capacity
     return (tot_energy, working_hours, equivalent_hours)
 
@@ -176,7 +247,7 @@ def quantile(array, qnumb=6, round_decimals=-2):
     while True:
         q0 = np.round(quantiles, round_decimals)
         if len(set(q0)) != len(quantiles):
-            print("Increase decimals")
+            logger.debug("Increase decimals")
             round_decimals += 1
         else:
             break
@@ -184,6 +255,85 @@ def quantile(array, qnumb=6, round_decimals=-2):
     return qvalues, q0
 
 
+def categorize(array, quantiles):
+    """Return the quantile category of each value of the array.
+
+    Category ``i`` contains the values in ``(quantiles[i-1], quantiles[i]]``,
+    the lower bound of the first category is ``quantiles[0] - 1``,
+    values outside the range are set to 0.
+
+    >>> categorize(np.array([0, 1, 2, 3, 4, 9]), np.array([1, 2, 4]))
+    array([0, 1, 1, 2, 2, 0], dtype=uint8)
+    """
+    edges = np.concatenate(([quantiles[0] - 1.0], quantiles[1:]))
+    array_cats = np.searchsorted(edges, array, side="left").astype(np.uint8)
+    # values above the last edge get len(edges) and wrap around to 0
+    array_cats %= len(edges)
+    return array_cats
+
+
+def blocks(xsize, ysize, bx, by):
+    """Return the windows (x0, y0, width, height) covering a raster by blocks.
+
+    >>> blocks(5, 3, 2, 2)
+    [(0, 0, 2, 2), (2, 0, 2, 2), (4, 0, 1, 2), (0, 2, 2, 1), (2, 2, 2, 1), (4, 2, 1, 1)]
+    """
+    return [
+        (x0, y0, min(bx, xsize - x0), min(by, ysize - y0))
+        for y0 in range(0, ysize, by)
+        for x0 in range(0, xsize, bx)
+    ]
+
+
+def _read_block(src, x0, y0, width, height):
+    """Return a window of an array or of a GDAL band."""
+    if isinstance(src, np.ndarray):
+        return src[y0 : y0 + height, x0 : x0 + width]
+    return src.ReadAsArray(x0, y0, width, height)
+
+
+def sample_valid(band, no_data_value=0, sample_size=1000000, seed=0):
+    """Return a random sample of the valid values of a band, with the
+    minimum, the maximum and the number of valid values.
+
+    The band is read once by blocks. Each valid value gets a random key
+    and the sample keeps the values with the sample_size smallest keys
+    (reservoir sampling), so all the valid values are kept when they are
+    no more than sample_size.
+    """
+    rng = np.random.default_rng(seed)
+
+    def reduce(samples, keys):
+        sample, key = np.concatenate(samples), np.concatenate(keys)
+        if sample.size > sample_size:
+            keep = np.argpartition(key, sample_size - 1)[:sample_size]
+            sample, key = sample[keep], key[keep]
+        return [sample], [key]
+
+    samples, keys, size = [], [], 0
+    min_value, max_value, count = None, None, 0
+    for window in blocks(band.XSize, band.YSize, *band.GetBlockSize()):
+        values = band.ReadAsArray(*window)
+        values = values[values != no_data_value]
+        if not values.size:
+            continue
+        count += values.size
+        block_min, block_max = values.min(), values.max()
+        min_value = block_min if min_value is None else min(min_value, block_min)
+        max_value = block_max if max_value is None else max(max_value, block_max)
+        samples.append(values)
+        keys.append(rng.random(values.size))
+        size += values.size
+        # reduce the buffer only when it doubles, to limit the copies
+        if size > 2 * sample_size:
+            samples, keys = reduce(samples, keys)
+            size = sample_size
+    if count == 0:
+        raise ValueError("The raster has no valid values")
+    samples, _ = reduce(samples, keys)
+    return samples[0], min_value, max_value, count
+
+
 def quantile_colors(
     array,
     output_suitable,
@@ -196,10 +346,32 @@ def quantile_colors(
     options="compress=DEFLATE TILED=YES TFW=YES" " ZLEVEL=9 PREDICTOR=1",
     round_decimals=-2,
     unit="kWh/yr",
+    factor=1.0,
+    sample_size=1000000,
+    sample=None,
 ):
     """Generate a GTiff categorical raster map based on quantiles
     values.
 
+    The array can also be the path of a raster file: it is then read by
+    blocks, the values are scaled by `factor` and the quantiles are
+    computed on a random sample of `sample_size` valid values, or on
+    `sample`, the result of sample_valid, when it has already been taken.
+    The first and last quantiles are widened to the minimum and maximum
+    valid values, so that no valid pixel falls in the no data category.
+
+    >>> array = np.random.default_rng(42).random((1500, 1500)) * 1000 + 1
+    >>> in_ds = gdal.GetDriverByName("GTiff").Create(
+    ...     "/vsimem/in.tif", 1500, 1500, 1, gdal.GDT_Float64)
+    >>> in_ds.GetRasterBand(1).WriteArray(array)
+    0
+    >>> in_ds = None
+    >>> out_ds, _ = quantile_colors("/vsimem/in.tif", "/vsimem/out.tif", "",
+    ...                             (0, 1, 0, 0, 0, -1), sample_size=1000)
+    >>> int((out_ds.GetRasterBand(1).ReadAsArray() == 0).sum())
+    0
+    The categories are computed and written by blocks of the output raster.
+
     "symbology": [
         {"red":50,"green":50,"blue":50,"opacity":0.5,"value":"50","label":"50MWh"},
         {"red":100,"green":150,"blue":10,"opacity":0.5,"value":"150MWh","label":"150MWh"},
@@ -207,10 +379,25 @@ def quantile_colors(
         {"red":50,"green":50,"blue":50,"opacity":0.5,"value":"250MWh","label":"250MWh"}
     ]
     """
-    valid = array != no_data_value
-    qvalues, quantiles = quantile(
-        array[valid], qnumb=qnumb, round_decimals=round_decimals
-    )
+    if isinstance(array, str):
+        in_ds = gdal.Open(array)
+        src = in_ds.GetRasterBand(1)
+        xsize, ysize = src.XSize, src.YSize
+        if sample is None:
+            sample = sample_valid(src, no_data_value, sample_size)
+        values, min_value, max_value, _ = sample
+    else:
+        src = array
+        ysize, xsize = array.shape
+        values = array[array != no_data_value]
+        min_value, max_value = values.min(), values.max()
+    if factor != 1:
+        values = values * factor
+    qvalues, quantiles = quantile(values, qnumb=qnumb, round_decimals=round_decimals)
+    # the sample and the rounding may miss the extremes of the raster
+    quantiles[0] = min(quantiles[0], min_value * factor)
+    quantiles[-1] = max(quantiles[-1], max_value * factor)
+    del values
 
     symbology = [
         {
@@ -223,31 +410,24 @@ def quantile_colors(
         }
     ]
 
-    # create a categorical derived map
-    array_cats = np.zeros_like(array, dtype=np.uint8)
+    # define the categories of the derived map
     qv0 = quantiles[0] - 1.0
-    array_cats[~valid] = 0
     for i, (qk, qv) in enumerate(zip(qvalues[1:], quantiles[1:])):
-        label = ("{qv0} {unit} < Solar potential <= {qv1} {unit}" "").format(
-            qv0=qv0, qv1=qv, unit=unit
-        )
-        print(label)
-        qindex = (qv0 < array) & (array <= qv)
-        array_cats[qindex] = i + 1
+        label = f"{qv0} {unit} < Solar potential <= {qv} {unit}"
+        logger.debug(label)
         qv0 = qv
         symbology.append(dict(value=int(i + 1), label=label))
 
     # create a color table
     ct = gdal.ColorTable()
     ct.SetColorEntry(no_data_value, no_data_color)
-    for i, (clr, symb) in enumerate(zip(CMAP_SUN(qvalues), symbology[1:])):
-        r, g, b, a = (np.array(clr) * 255).astype(np.uint8)
+    rgba = (CMAP_SUN(qvalues) * 255).astype(np.uint8).tolist()
+    for i, ((r, g, b, a), symb) in enumerate(zip(rgba, symbology[1:])):
         ct.SetColorEntry(i + 1, (r, g, b, a))
-        symb.update(dict(red=int(r), green=int(g), blue=int(b), opacity=int(a)))
+        symb.update(dict(red=r, green=g, blue=b, opacity=a))
 
     # create a new raster map
     gtiff_driver = gdal.GetDriverByName("GTiff")
-    ysize, xsize = array_cats.shape
 
     out_ds = gtiff_driver.Create(
         output_suitable, xsize, ysize, 1, gtype, options.split()
@@ -258,7 +438,19 @@ def quantile_colors(
     out_ds_band = out_ds.GetRasterBand(1)
     out_ds_band.SetNoDataValue(no_data_value)
     out_ds_band.SetColorTable(ct)
-    out_ds_band.WriteArray(array_cats)
+    # traverse the raster following the blocks (tiles) of the GTiff, so
+    # each write fills exactly one block
+    windows = blocks(xsize, ysize, *out_ds_band.GetBlockSize())
+
+    def categorize_block(block):
+        array_cats = categorize(block * factor if factor != 1 else block, quantiles)
+        # clear no data values in place
+        array_cats *= block != no_data_value
+        return array_cats
+
+    for x0, y0, width, height in windows:
+        array_cats = categorize_block(_read_block(src, x0, y0, width, height))
+        out_ds_band.WriteArray(array_cats, x0, y0)
     out_ds.FlushCache()
     return out_ds, symbology
 
@@ -288,7 +480,7 @@ def line(
             {
                 "label": lab,
                 "backgroundColor": palette[i],
-                "data": ["{:7.3f}".format(y) for y in y_values[i]],
+                "data": [f"{y:7.3f}" for y in y_values[i]],
             }
         )
 
@@ -311,9 +503,9 @@ def reducelabels(x, steps=10):
     >>> reducelabels(x, steps=3)
     ['0', '', '', '3', '', '', '6', '', '', '9']
     """
-    x_rep = ["" for i in range(0, len(x))]
-    for i in range(0, len(x), round(len(x) / steps)):
-        x_rep[i] = x[i]
+    stride = max(1, round(len(x) / steps))
+    x_rep = [""] * len(x)
+    x_rep[::stride] = x[::stride]
     return x_rep
 
 
@@ -6,10 +6,35 @@ Created on Mon Jun 17 15:25:16 2019
 @author: ggaregnani
 """
 
-from typing import Any, Tuple
+from functools import lru_cache
+from typing import Any, List, Sequence, Tuple
 from osgeo import osr
 import numpy as np
 
+WGS84_WKT = """
+GEOGCS["WGS 84",
+    DATUM["WGS_1984",
+        SPHEROID["WGS 84",6378137,298.257223563,
+            AUTHORITY["EPSG","7030"]],
+        AUTHORITY["EPSG","6326"]],
+    PRIMEM["Greenwich",0,
+        AUTHORITY["EPSG","8901"]],
+    UNIT["degree",0.01745329251994328,
+        AUTHORITY["EPSG","9122"]],
+    AUTHORITY["EPSG","4326"]]"""
+
+
+@lru_cache(maxsize=8)
+def _build_transform(src_wkt: str) -> Any:
+    """Return the transformation from the src_wkt projection to WGS84"""
+    old_cs = osr.SpatialReference()
+    old_cs.ImportFromWkt(src_wkt)
+    # create the new coordinate system
+    new_cs = osr.SpatialReference()
+    new_cs.ImportFromWkt(WGS84_WKT)
+    # create a transform object to convert between coordinate systems
+    return osr.CoordinateTransformation(old_cs, new_cs)
+
 
 def xy2latlong(x: float, y: float, ds: Any) -> Tuple[float, float]:
     """Return lat long coordinate by x, y
@@ -20,29 +45,28 @@ def xy2latlong(x: float, y: float, ds: Any) -> Tuple[float, float]:
     >>> xy2latlong(3715171, 2909857, ds)
     (1.7036231518576481, 48.994284431891565)
     """
-    old_cs = osr.SpatialReference()
-    old_cs.ImportFromWkt(ds.GetProjectionRef())
-    # create the new coordinate system
-    wgs84_wkt = """
-    GEOGCS["WGS 84",
-        DATUM["WGS_1984",
-            SPHEROID["WGS 84",6378137,298.257223563,
-                AUTHORITY["EPSG","7030"]],
-            AUTHORITY["EPSG","6326"]],
-        PRIMEM["Greenwich",0,
-            AUTHORITY["EPSG","8901"]],
-        UNIT["degree",0.01745329251994328,
-            AUTHORITY["EPSG","9122"]],
-        AUTHORITY["EPSG","4326"]]"""
-    new_cs = osr.SpatialReference()
-    new_cs.ImportFromWkt(wgs84_wkt)
-    # create a transform object to convert between coordinate systems
-    transform = osr.CoordinateTransformation(old_cs, new_cs)
+    transform = _build_transform(ds.GetProjectionRef())
     # get the coordinates in lat long
     latlong = transform.TransformPoint(x, y)
     return latlong[0], latlong[1]
 
 
+def xy2latlong_many(
+    xs: Sequence[float], ys: Sequence[float], ds: Any
+) -> List[Tuple[float, float]]:
+    """Return lat long coordinates of several x, y points at once
+
+    >>> import gdal
+    >>> path = "../../../tests/data/raster_for_test.tif"
+    >>> ds = gdal.Open(path)
+    >>> xy2latlong_many([3715171], [2909857], ds)
+    [(1.7036231518576481, 48.994284431891565)]
+    """
+    transform = _build_transform(ds.GetProjectionRef())
+    latlongs = transform.TransformPoints(list(zip(xs, ys)))
+    return [(latlong[0], latlong[1]) for latlong in latlongs]
+
+
 def diff_raster(raster_in: Any, raster_out: Any) -> float:
     """
     Verify the position of the pixel and the consistent with the input file
@@ -56,12 +80,37 @@ def diff_raster(raster_in: Any, raster_out: Any) -> float:
     >>> diff_raster(raster_in, raster_out)
     0.4
     """
-    # count cell of the two rasters
-    diff = np.nansum(raster_in) - np.nansum(raster_out)
-    error = diff / np.nansum(raster_in)
+    # count cell of the two rasters, summing the input only once
+    total_in = np.nansum(raster_in)
+    diff = total_in - np.nansum(raster_out)
+    error = diff / total_in
     return error
 
 
+def _resize_index(
+    size: int, incr: float, offset: int, new_size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the destination indexes and the source indexes that fill them
+
+    Each source cell is copied to ``int(incr)`` destination cells starting
+    from ``max(0, int(index * incr) + offset)``, the last source cell wins
+    where the ranges overlap.
+
+    >>> _resize_index(3, 2.0, 1, 6)
+    (array([1, 2, 3, 4, 5]), array([0, 0, 1, 1, 2]))
+    """
+    step = int(incr)
+    starts = np.maximum(0, (np.arange(size) * incr).astype(int) + offset)
+    indexes = np.arange(new_size)
+    # starts are sorted, so the last source cell starting before each
+    # destination cell is the only candidate to cover it
+    sources = np.searchsorted(starts, indexes, side="right") - 1
+    covered = sources >= 0
+    covered[covered] = indexes[covered] < starts[sources[covered]] + step
+    return indexes[covered], sources[covered]
+
+
 def raster_resize(ras1: Any, ras2: Any) -> Any:
     """
     Adapt the resoltution and the extent of raster1 to raster2
@@ -70,28 +119,40 @@ def raster_resize(ras1: Any, ras2: Any) -> Any:
     :param raster2: gdal object
 
     :returns a new_matrix with array1 values and array2
-    dimension and resolution
+    dimension and resolution, no data values of raster1 are set to 0,
+    as well as NaN values of floating point rasters
     """
-    matrix1 = np.nan_to_num(ras1.ReadAsArray())
-    matrix2 = ras2.ReadAsArray()
-    matrix2 = np.nan_to_num(matrix2)
+    matrix1 = ras1.ReadAsArray()
+    nodata = ras1.GetRasterBand(1).GetNoDataValue()
+    floating = np.issubdtype(matrix1.dtype, np.floating)
+    if nodata is None or np.isnan(nodata):
+        if floating:
+            np.nan_to_num(matrix1, copy=False)
+    else:
+        # clear no data and NaN with a single mask
+        mask = matrix1 == nodata
+        if floating:
+            np.logical_or(mask, np.isnan(matrix1), out=mask)
+        np.putmask(matrix1, mask, 0)
+        # infinite values are rare, keep the nan_to_num handling for them
+        if floating and np.isinf(matrix1).any():
+            np.nan_to_num(matrix1, copy=False)
     ds_1 = ras1.GetGeoTransform()
     ds_2 = ras2.GetGeoTransform()
     x_offset = int((ds_2[0] - ds_1[0]) / ds_2[1])
     y_offset = int((ds_2[3] - ds_1[3]) / (-ds_2[5]))
     x_incr = ds_1[1] / ds_2[1]
     y_incr = ds_1[5] / ds_2[5]
-    # ds_2 = ras2.GetGeoTransform()
     # resize shape
-    new_matrix = np.zeros(matrix2.shape)
-    for y in range(0, matrix1.shape[0]):
-        i = max(0, int(y * y_incr) + y_offset)
-        i_incr = min(i + int(y_incr), new_matrix.shape[0])
-        for x in range(0, matrix1.shape[1]):
-            j = max(0, int(x * x_incr) - x_offset)
-            j_incr = min(j + int(x_incr), new_matrix.shape[1])
-            print(i, j)
-            new_matrix[i:i_incr, j:j_incr] = matrix1[y, x]
+    # only the shape of raster2 is needed, avoid reading its values
+    new_matrix = np.zeros((ras2.RasterYSize, ras2.RasterXSize))
+    rows, src_rows = _resize_index(
+        matrix1.shape[0], y_incr, y_offset, new_matrix.shape[0]
+    )
+    cols, src_cols = _resize_index(
+        matrix1.shape[1], x_incr, -x_offset, new_matrix.shape[1]
+    )
+    new_matrix[np.ix_(rows, cols)] = matrix1[np.ix_(src_rows, src_cols)]
     return new_matrix
 
     # allignement
@@ -112,11 +173,14 @@ def get_lat_long(ds: Any, most_suitable: Any) -> Tuple[float, float]:
     """
     Return the lat_long of the pixel with mean value of the resources
     """
-    diff = most_suitable - np.mean(most_suitable[most_suitable > 0])
-    i, j = np.unravel_index(np.abs(diff).argmin(), diff.shape)
+    mean_val = most_suitable[most_suitable > 0].mean()
+    # take the absolute value in place to avoid a second raster copy
+    diff = most_suitable - mean_val
+    flat = np.argmin(np.abs(diff, out=diff))
+    row, col = np.unravel_index(flat, most_suitable.shape)
     ds_geo = ds.GetGeoTransform()
-    x = ds_geo[0] + i * ds_geo[1]
-    y = ds_geo[3] + j * ds_geo[5]
+    x = ds_geo[0] + col * ds_geo[1]
+    y = ds_geo[3] + row * ds_geo[5]
     long, lat = xy2latlong(x, y, ds)
     # generation of the output time profile
     return lat, long